@@ -28,6 +28,8 @@ TMT Diana provisioner plugin that allows to use libvirt hypervisor and fully cus
 
 %package -n tmt-provision-diana
 Requires: tmt
+Requires: python3-libvirt
+Requires: python3-cryptography
 Summary: TMT Diana provisioner plugin
 
 %description -n tmt-provision-diana
@@ -1,13 +1,25 @@
 # coding: utf-8
 
+import atexit
+import contextlib
 import dataclasses
+import fcntl
+import hashlib
+import http.server
+import json
 import os
+import re
+import threading
 import time
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Union
-from copy import deepcopy
+import urllib.parse
+import xml.etree.ElementTree as ET
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import subprocess
 import jinja2
+import libvirt
+from cryptography.exceptions import UnsupportedAlgorithm
+from cryptography.hazmat.primitives import serialization
 
 import tmt
 import tmt.steps
@@ -27,9 +39,202 @@ if TYPE_CHECKING:
     import tmt.base
 
 DEFAULT_CONNECT_TIMEOUT = 60   # seconds
+CONNECT_TICK = 0.2             # seconds
+CONNECT_TICK_INCREASE = 1.02   # tick stays below 1.5 s within the timeout
 DEFAULT_USER = 'root'
+STATE_CACHE_TTL = 0.5          # seconds
+DEFAULT_DISK_SIZE = 20         # GiB
+GUEST_IP_TIMEOUT = 10          # seconds
+INSTALL_SLOT_TICK = 1          # seconds
+INSTALL_WATCH_TICK = 1         # seconds
+INSTALL_TIMEOUT = 120          # minutes
+
+# Maximum number of concurrent virt-install runs across all tmt processes
+INSTALL_LIMIT_VARIABLE = 'TMT_DIANA_INSTALL_LIMIT'
+INSTALL_LOCK_PREFIX = '.diana-install.lock'
+
+# Libvirt network the guests are connected to by virt-install
+DEFAULT_NETWORK = 'default'
+
+# Installer console output which means the installation is not going
+# to finish
+INSTALL_ERROR_PATTERN = re.compile(
+    r'Traceback \(most recent call last\)'
+    r'|An unknown error has occurred'
+    r'|[Cc]annot download'
+    r'|Pane is dead')
+
+# Installed base images are kept as shut off domains named after the hash
+# of everything which influences the installation, ssh keys are stored here
+IMAGE_CACHE_ROOT = WORKDIR_ROOT / '.diana-cache'
+IMAGE_CACHE_PREFIX = 'diana-base-'
+
+# Minimal libvirt and qemu versions supporting io_uring disk backend
+IO_URING_LIBVIRT_VERSION = 6003000
+IO_URING_QEMU_VERSION = 5000000
+
+# Human readable names of libvirt domain states, matching `virsh domstate`
+DOMAIN_STATES = {
+    libvirt.VIR_DOMAIN_NOSTATE: 'no state',
+    libvirt.VIR_DOMAIN_RUNNING: 'running',
+    libvirt.VIR_DOMAIN_BLOCKED: 'idle',
+    libvirt.VIR_DOMAIN_PAUSED: 'paused',
+    libvirt.VIR_DOMAIN_SHUTDOWN: 'in shutdown',
+    libvirt.VIR_DOMAIN_SHUTOFF: 'shut off',
+    libvirt.VIR_DOMAIN_CRASHED: 'crashed',
+    libvirt.VIR_DOMAIN_PMSUSPENDED: 'pmsuspended',
+    }
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread: Optional[threading.Thread] = None
+
+
+def _run_event_loop() -> None:
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def _start_event_loop() -> None:
+    """ Start the libvirt event loop thread unless already running """
+    global _event_loop_thread
+    with _event_loop_lock:
+        if _event_loop_thread is not None:
+            return
+        # Domain events are delivered by the default event loop
+        # implementation, which has to be registered before any connection
+        # is opened. Done only when diana is actually used, as it affects
+        # all libvirt users in the process.
+        libvirt.virEventRegisterDefaultImpl()
+        _event_loop_thread = threading.Thread(
+            target=_run_event_loop, name='diana-libvirt-events', daemon=True)
+        _event_loop_thread.start()
+
+
+def _install_limit() -> int:
+    limit = os.environ.get(INSTALL_LIMIT_VARIABLE)
+    if limit:
+        try:
+            return max(1, int(limit))
+        except ValueError:
+            raise ProvisionError(
+                f"Invalid {INSTALL_LIMIT_VARIABLE} value '{limit}', "
+                "expected a number.")
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+@contextlib.contextmanager
+def _install_slot() -> Iterator[None]:
+    """
+    Hold one of the limited installation slots shared by tmt processes
+
+    Each slot is a lock file under the workdir root, the first one which
+    can be locked is held until the context is left.
+    """
+    WORKDIR_ROOT.mkdir(parents=True, exist_ok=True)
+    limit = _install_limit()
+    while True:
+        for slot in range(limit):
+            # Read-only access is enough for flock() and works for lock
+            # files created by other users as well
+            lock = os.open(
+                WORKDIR_ROOT / f'{INSTALL_LOCK_PREFIX}.{slot}',
+                os.O_RDONLY | os.O_CREAT,
+                0o644)
+            try:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                return
+            finally:
+                os.close(lock)
+        time.sleep(INSTALL_SLOT_TICK)
+
+
+# Libvirt connections shared by all guests, keyed by (uri, readonly)
+_connections: Dict[Tuple[str, bool], libvirt.virConnect] = {}
+_connections_lock = threading.Lock()
+
+
+def _get_conn(uri: str, readonly: bool = False) -> libvirt.virConnect:
+    """ Libvirt connection shared by all guests using the same hypervisor """
+    with _connections_lock:
+        conn = _connections.get((uri, readonly))
+        # Reopen connections lost e.g. due to libvirtd restart
+        if conn is not None and not conn.isAlive():
+            try:
+                conn.close()
+            except libvirt.libvirtError:
+                pass
+            conn = None
+        if conn is None:
+            _start_event_loop()
+            conn = libvirt.openReadOnly(uri) if readonly else libvirt.open(uri)
+            _connections[(uri, readonly)] = conn
+        return conn
+
+
+@atexit.register
+def _close_connections() -> None:
+    with _connections_lock:
+        for conn in _connections.values():
+            try:
+                conn.close()
+            except libvirt.libvirtError:
+                pass
+        _connections.clear()
+
+
+def _kickstart_server(
+        address: str, content: bytes) -> http.server.ThreadingHTTPServer:
+    """ Create http server bound to given address serving the kickstart """
+    class KickstartHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
 
-KICKSTART_TEMPLATE = jinja2.Template(
+    return http.server.ThreadingHTTPServer((address, 0), KickstartHandler)
+
+
+@contextlib.contextmanager
+def _serve_kickstart(server: http.server.ThreadingHTTPServer) -> Iterator[str]:
+    """ Run the kickstart server in background, yield the kickstart url """
+    address, port = server.server_address[:2]
+    thread = threading.Thread(
+        target=server.serve_forever, name='diana-kickstart', daemon=True)
+    thread.start()
+    try:
+        yield f'http://{address}:{port}/ks.cfg'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def _locked(path: Path) -> Iterator[None]:
+    """ Hold exclusive lock on given file, waiting for it if necessary """
+    lock = os.open(path, os.O_RDONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    finally:
+        os.close(lock)
+
+
+KICKSTART_TEMPLATE = (
 """
 # partitioning
 clearpart --all --initlabel
@@ -57,6 +262,34 @@ source /etc/os-release
 """
 )
 
+_kickstart_environment_lock = threading.Lock()
+_kickstart_environment: Optional[jinja2.Environment] = None
+
+
+def _get_kickstart_environment() -> jinja2.Environment:
+    """
+    Environment holding the kickstart template, created on first use
+
+    Compiled template is kept in memory and its bytecode cached on disk
+    so that it is not compiled again for every guest or tmt run. The
+    cache directory is created only when diana is actually used.
+    """
+    global _kickstart_environment
+    with _kickstart_environment_lock:
+        if _kickstart_environment is None:
+            try:
+                bytecode_cache: Optional[jinja2.BytecodeCache] = \
+                    jinja2.FileSystemBytecodeCache()
+            except OSError:
+                bytecode_cache = None
+            _kickstart_environment = jinja2.Environment(
+                loader=jinja2.DictLoader({'ks.cfg': KICKSTART_TEMPLATE}),
+                auto_reload=False,
+                bytecode_cache=bytecode_cache,
+            )
+        return _kickstart_environment
+
+
 @dataclasses.dataclass
 class DianaGuestData(tmt.steps.provision.GuestSshData):
     connection_uri: Optional[str] = field(
@@ -83,10 +316,36 @@ class DianaGuestData(tmt.steps.provision.GuestSshData):
         help='Optional Beaker kickstart to use when provisioning the guest.',
         multiple=True,
     )
+    kickstart_server: bool = field(
+        default=False,
+        option='--kickstart-server',
+        is_flag=True,
+        help='Serve kickstart over http from the host instead of injecting '
+             'it into initrd. Guest must be able to reach the host address '
+             'on the default libvirt network, works with local connection only.',
+    )
+    io_uring: bool = field(
+        default=False,
+        option='--io-uring',
+        is_flag=True,
+        help='Use io_uring disk backend if libvirt and qemu are recent enough. '
+             'Make sure io_uring is not disabled on the hypervisor.',
+    )
+    image_cache: bool = field(
+        default=False,
+        option='--image-cache',
+        is_flag=True,
+        help='Install the system once and clone the installed domain for '
+             'guests with the same location and kickstart.',
+    )
 
 @dataclasses.dataclass
 class ProvisionDianaData(DianaGuestData, tmt.steps.provision.ProvisionStepData):
-    pass
+    def __post_init__(self) -> None:
+        # Validated once when the configuration is loaded
+        if self.hardware:
+            raise ProvisionError(
+                'Hardware requirements are not yet supported by diana.')
 
 class GuestDiana(tmt.GuestSsh):
     """
@@ -103,6 +362,15 @@ class GuestDiana(tmt.GuestSsh):
     connection_uri: str
     location: str
     instance_name: Optional[str]
+    kickstart_server: bool
+    io_uring: bool
+    image_cache: bool
+
+    # (monotonic timestamp, state) of the last domain state query
+    _state_cache: Optional[Tuple[float, str]] = None
+    _keygen_process: Optional[subprocess.Popen] = None
+    _ssh_pubkey_cache: Optional[str] = None
+    _image_cache_hash_value: Optional[str] = None
 
     @property
     def is_ready(self) -> bool:
@@ -110,89 +378,429 @@ class GuestDiana(tmt.GuestSsh):
             return False
         return super().is_ready
 
+    @property
+    def _conn(self) -> libvirt.virConnect:
+        return _get_conn(self.connection_uri)
+
+    @property
+    def _conn_ro(self) -> libvirt.virConnect:
+        """ Read-only libvirt connection used for state and address queries """
+        return _get_conn(self.connection_uri, readonly=True)
+
+    @property
+    def _domain(self) -> libvirt.virDomain:
+        return self._conn.lookupByName(self.instance_name)
+
+    @property
+    def _domain_ro(self) -> libvirt.virDomain:
+        return self._conn_ro.lookupByName(self.instance_name)
+
     @property
     def guest_state(self) -> str:
-        return self._virsh(
-            'domstate', self.instance_name,
-            capture_output=True, encoding='utf-8'
-        ).stdout.splitlines()[0]
+        now = time.monotonic()
+        if self._state_cache and now - self._state_cache[0] < STATE_CACHE_TTL:
+            return self._state_cache[1]
+        state = DOMAIN_STATES[self._domain_ro.state()[0]]
+        self._state_cache = (now, state)
+        return state
+
+    def _invalidate_state(self) -> None:
+        """ Forget cached domain state after an operation changing it """
+        self._state_cache = None
+
+    def _wait_for_state(self, state: str, timeout: float) -> bool:
+        """ Wait until domain reaches given state, return True if it did """
+        changed = threading.Event()
+        callback_id = self._conn.domainEventRegisterAny(
+            self._domain,
+            libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+            lambda *args: changed.set(),
+            None)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                changed.clear()
+                self._invalidate_state()
+                if self.guest_state == state:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not changed.wait(remaining):
+                    return False
+        finally:
+            self._conn.domainEventDeregisterAny(callback_id)
+
+    @property
+    def _io_uring_supported(self) -> bool:
+        return (self._conn.getLibVersion() >= IO_URING_LIBVIRT_VERSION
+                and self._conn.getVersion() >= IO_URING_QEMU_VERSION)
+
+    @property
+    def _disk_args(self) -> List[str]:
+        """ virt-install disk options, its defaults unless io_uring is requested """
+        if not self.io_uring:
+            return []
+        if not self._io_uring_supported:
+            self.warn('io_uring is not supported by the hypervisor, using default disk.')
+            return []
+        options = [
+            f'size={DEFAULT_DISK_SIZE}',
+            'format=qcow2',
+            'cache=none',
+            'discard=unmap',
+            'io=io_uring',
+            ]
+        return ['--disk', ','.join(options)]
 
     def get_guest_ip(self) -> str:
-        for i in range(10):
-            try:
-                return self._virsh(
-                    'domifaddr', self.instance_name,
-                    capture_output=True, encoding='utf-8'
-                ).stdout.splitlines()[-2].split()[-1].split('/')[0]
-            except subprocess.CalledProcessError as e:
-                time.sleep(1)
-        raise e
+        deadline = time.monotonic() + GUEST_IP_TIMEOUT
+        delay = 0.1
+        while True:
+            interfaces = self._domain_ro.interfaceAddresses(
+                libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
+            address = next(
+                (
+                    address['addr']
+                    for interface in interfaces.values()
+                    for address in interface['addrs'] or []
+                    if address['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4
+                ),
+                None)
+            if address:
+                return address
+            if time.monotonic() >= deadline:
+                break
+            # Lease usually appears within a few hundred milliseconds
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        raise ProvisionError(
+            f'Failed to get IP address of libvirt guest {self.instance_name}.')
+
+    @property
+    def _kickstart_template(self) -> jinja2.Template:
+        return _get_kickstart_environment().get_template('ks.cfg')
 
     @property
     def _kickstart(self) -> str:
-        return KICKSTART_TEMPLATE.render(guest=self)
+        return self._kickstart_template.render(guest=self)
     
     def wake(self) -> None:
         return super().wake()
 
-    def _virsh(self, *args, **kwargs) -> subprocess.CompletedProcess:
-        kwargs.setdefault('check', True)
-        return subprocess.run(
-            [
-                'virsh',
-                '-c', self.connection_uri,
-            ] + list(args),
-            **kwargs,
-        )
-
     def _install(self) -> None:
         try:
             self.guest_state
             return
-        except subprocess.CalledProcessError:
+        except libvirt.libvirtError:
             pass
-        hardware = deepcopy(self.hardware)
+        if self.image_cache:
+            self._install_from_cache()
+        else:
+            self._virt_install(self.instance_name)
+
+    @property
+    def _image_cache_hash(self) -> str:
+        if self._image_cache_hash_value is None:
+            # The kickstart itself cannot be used as it contains the public
+            # key which is generated into the cache directory, user provided
+            # keys are identified by their path instead
+            data = json.dumps([
+                self.connection_uri,
+                self.location,
+                self.user,
+                self.kickstart,
+                self.io_uring,
+                [str(key) for key in self.key or []],
+                KICKSTART_TEMPLATE,
+                ], sort_keys=True)
+            self._image_cache_hash_value = hashlib.sha256(
+                data.encode('utf-8')).hexdigest()
+        return self._image_cache_hash_value
+
+    @property
+    def _image_cache_dir(self) -> Path:
+        return IMAGE_CACHE_ROOT / self._image_cache_hash
+
+    def _install_from_cache(self) -> None:
+        """ Clone the guest from cached base domain, install it if missing """
+        base_name = IMAGE_CACHE_PREFIX + self._image_cache_hash[:16]
+        self._image_cache_dir.mkdir(parents=True, exist_ok=True)
+        key_path = Path(self.key[0]) if self.key else self._image_cache_dir / 'ssh_key'
+        with _locked(self._image_cache_dir / '.lock'):
+            try:
+                self._conn.lookupByName(base_name)
+            except libvirt.libvirtError:
+                self._virt_install(base_name)
+            else:
+                # Base image authorizes only the key it was installed with,
+                # it is not discarded as clones may still use its disk
+                if not key_path.exists():
+                    raise ProvisionError(
+                        f"Key '{key_path}' of cached image '{base_name}' is "
+                        f"missing, remove the domain to install it again.")
+                self.verbose('image', f'reusing {base_name}', 'green')
+            # Make sure the key used by the cached image is available
+            self._generate_ssh_key()
+        self.info('progress', 'cloning...', 'cyan')
+        overlays = self._create_overlays(self._conn.lookupByName(base_name))
+        try:
+            subprocess.run(
+                [
+                    'virt-clone',
+                    '--connect', self.connection_uri,
+                    '--original', base_name,
+                    '--name', self.instance_name,
+                    '--preserve-data',
+                    *[option
+                      for overlay in overlays
+                      for option in ('--file', overlay.path())],
+                ],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+        except subprocess.CalledProcessError:
+            for overlay in overlays:
+                overlay.delete()
+            raise
+
+    def _create_overlays(self, base: libvirt.virDomain) -> List[libvirt.virStorageVol]:
+        """ Create copy-on-write volumes backed by disks of the base domain """
+        base_xml = ET.fromstring(base.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        overlays: List[libvirt.virStorageVol] = []
+        try:
+            for index, source in enumerate(base_xml.findall(
+                    "./devices/disk[@device='disk']/source[@file]")):
+                backing = self._conn.storageVolLookupByPath(source.get('file'))
+                backing_format = ET.fromstring(backing.XMLDesc()).find(
+                    './target/format').get('type')
+                overlay_xml = ET.Element('volume')
+                ET.SubElement(overlay_xml, 'name').text = \
+                    f'{self.instance_name}-{index}.qcow2'
+                ET.SubElement(overlay_xml, 'capacity', unit='bytes').text = \
+                    str(backing.info()[1])
+                target = ET.SubElement(overlay_xml, 'target')
+                ET.SubElement(target, 'format', type='qcow2')
+                backing_store = ET.SubElement(overlay_xml, 'backingStore')
+                ET.SubElement(backing_store, 'path').text = backing.path()
+                ET.SubElement(backing_store, 'format', type=backing_format)
+                overlays.append(backing.storagePoolLookupByVolume().createXML(
+                    ET.tostring(overlay_xml, encoding='unicode')))
+        except libvirt.libvirtError:
+            for overlay in overlays:
+                overlay.delete()
+            raise
+        return overlays
+
+    @property
+    def _is_local(self) -> bool:
+        """ True if the hypervisor runs on this host """
+        return urllib.parse.urlparse(self.connection_uri).hostname in (None, 'localhost')
+
+    @property
+    def _kickstart_server_address(self) -> Optional[str]:
+        """ Host address to serve kickstart on, None to inject it instead """
+        if not self.kickstart_server:
+            return None
+        # Guests of a remote hypervisor cannot reach this host
+        if not self._is_local:
+            return None
+        try:
+            network = self._conn.networkLookupByName(DEFAULT_NETWORK)
+        except libvirt.libvirtError:
+            return None
+        ip = ET.fromstring(network.XMLDesc()).find('./ip[@address]')
+        return ip.get('address') if ip is not None else None
+
+    @contextlib.contextmanager
+    def _kickstart_args(self) -> Iterator[List[str]]:
+        """ Provide kickstart to the installer, yield virt-install options """
+        address = self._kickstart_server_address
+        if address:
+            try:
+                server = _kickstart_server(
+                    address, self._kickstart.encode('utf-8'))
+            except OSError as error:
+                self.warn(
+                    f"Failed to serve kickstart on '{address}' ({error}), "
+                    "injecting it into initrd instead.")
+            else:
+                with _serve_kickstart(server) as url:
+                    yield ['--extra-args', f'console=ttyS0 inst.ks={url}']
+                return
+        # Kickstart is read just once by virt-install, keep it in memory
+        # if possible instead of writing it to the workdir
+        if hasattr(os, 'memfd_create'):
+            fd = os.memfd_create('ks.cfg')
+            ksfile = open(fd, 'w', closefd=False)
+            ks_path = Path(f'/proc/{os.getpid()}/fd/{fd}')
+        else:
+            fd = None
+            ks_path = self.workdir / 'ks.cfg'
+            ksfile = open(ks_path, 'w')
+        try:
+            with ksfile:
+                self._kickstart_template.stream(guest=self).dump(ksfile)
+            yield [
+                '--extra-args', f'console=ttyS0 inst.ks=file://{ks_path.name}',
+                '--initrd-inject', str(ks_path),
+                ]
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _virt_install(self, name: str) -> None:
         self.verbose('progress', 'preparing for installation...', 'cyan')
-        with open(self.workdir / 'ks.cfg', 'w') as ksfile:
-            ksfile.write(self._kickstart)
-            ksfile.flush()
+        # virsh console needs a tty, log the installer console to a file
+        # which can be watched instead, paths are opened by the hypervisor
+        # so this works only for the local one
+        console_log = self.workdir / f'{name}-console.log' if self._is_local else None
+        with self._kickstart_args() as kickstart_args:
             cmd = [
                     'virt-install',
                     '--connect', self.connection_uri,
-                    '--name', self.instance_name,
+                    '--name', name,
                     '--memory', '4096',
                     '--vcpus', '4',
                     '--graphics', 'none',
-                    '--extra-args', 'console=ttyS0 inst.ks=file://'+os.path.basename(ksfile.name),
-                    '--initrd-inject', ksfile.name,
+                    *(['--serial', f'file,path={console_log}'] if console_log else []),
+                    '--noautoconsole',
+                    *self._disk_args,
+                    *kickstart_args,
                     '--noreboot',
+                    '--wait', str(INSTALL_TIMEOUT),
                     '--location', self.location,
                 ]
-            # Make sure that all hardware requirements were respected
-            assert not hardware
-            self.info('progress', 'installing...', 'cyan')
-            subprocess.run(
-                cmd,
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
+            self.verbose('progress', 'waiting for installation slot...', 'cyan')
+            with _install_slot():
+                self.info('progress', 'installing...', 'cyan')
+                try:
+                    self._run_virt_install(cmd, console_log)
+                except (ProvisionError, subprocess.CalledProcessError):
+                    self._discard(name)
+                    raise
+        if console_log:
+            self._use_pty_console(name)
+
+    def _run_virt_install(self, cmd: List[str], console_log: Optional[Path]) -> None:
+        """
+        Run virt-install, stop it as soon as the installation fails
+
+        The installer console log is checked for known failures while
+        virt-install is running. It is only available for hypervisors
+        running on this host, remote installations are limited just by
+        the timeout passed to virt-install.
+        """
+        console = None
+        buffer = ''
+        with open(self.workdir / 'virt-install.log', 'w') as output, \
+                subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=output,
+                    stderr=subprocess.STDOUT) as process:
+            try:
+                while process.poll() is None:
+                    time.sleep(INSTALL_WATCH_TICK)
+                    if console_log is None:
+                        continue
+                    try:
+                        if console is None:
+                            if not console_log.exists():
+                                continue
+                            console = open(console_log, encoding='utf-8', errors='replace')
+                        buffer += console.read()
+                    except OSError as error:
+                        # E.g. log created by virtlogd is not readable for us,
+                        # keep waiting for virt-install without watching it
+                        self.warn(f"Cannot watch installer console ({error}).")
+                        console_log = None
+                        continue
+                    *lines, buffer = buffer.split('\n')
+                    for line in lines:
+                        self.debug('console', line.rstrip(), level=3)
+                        if INSTALL_ERROR_PATTERN.search(line):
+                            process.terminate()
+                            raise ProvisionError(
+                                f'Installation failed: {line.strip()}')
+            finally:
+                if console is not None:
+                    console.close()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+    def _use_pty_console(self, name: str) -> None:
+        """ Switch serial console of installed domain back to a pty """
+        domain = self._conn.lookupByName(name)
+        domain_xml = ET.fromstring(
+            domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        for device in domain_xml.findall("./devices/*[@type='file']"):
+            if device.tag not in ('serial', 'console'):
+                continue
+            device.set('type', 'pty')
+            for source in device.findall('source'):
+                device.remove(source)
+        self._conn.defineXML(ET.tostring(domain_xml, encoding='unicode'))
+
+    def _discard(self, name: str) -> None:
+        """ Remove leftovers of a failed installation """
+        try:
+            domain = self._conn.lookupByName(name)
+        except libvirt.libvirtError:
             return
+        if domain.isActive():
+            domain.destroy()
+        self._undefine(domain)
     
-    def _generate_ssh_key(self) -> None:
+    def _start_ssh_keygen(self) -> None:
+        """ Start generating the ssh key in background if there is none """
         if self.key:
             return
-        self.key = [ self.workdir / 'ssh_key' ]
-        subprocess.run(
-            ['ssh-keygen', '-f', self.key[0], '-N', ''],
-            check=True,
+        key_dir = self._image_cache_dir if self.image_cache else self.workdir
+        self.key = [ key_dir / 'ssh_key' ]
+        # Key generated by a previous run is reused
+        if self.key[0].exists():
+            return
+        self._keygen_process = subprocess.Popen(
+            ['ssh-keygen', '-q', '-f', self.key[0], '-N', ''],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
         )
 
+    def _generate_ssh_key(self) -> None:
+        self._start_ssh_keygen()
+        if self._keygen_process is None:
+            return
+        process, self._keygen_process = self._keygen_process, None
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
     @property
     def ssh_pubkey(self) -> str:
+        if self._ssh_pubkey_cache is None:
+            self._ssh_pubkey_cache = self._read_ssh_pubkey()
+        return self._ssh_pubkey_cache
+
+    def _read_ssh_pubkey(self) -> str:
+        """ Read public key stored by ssh-keygen, derive it if missing """
         self._generate_ssh_key()
+        pubkey_path = Path(f'{self.key[0]}.pub')
+        if pubkey_path.exists():
+            return pubkey_path.read_text().rstrip('\n')
+        private_bytes = Path(self.key[0]).read_bytes()
+        for load in (
+                serialization.load_ssh_private_key,
+                serialization.load_pem_private_key):
+            try:
+                private_key = load(private_bytes, password=None)
+            except (ValueError, TypeError, UnsupportedAlgorithm):
+                continue
+            return private_key.public_key().public_bytes(
+                serialization.Encoding.OpenSSH,
+                serialization.PublicFormat.OpenSSH,
+            ).decode('utf-8')
+        # Leave formats unknown to cryptography to ssh-keygen
         return subprocess.run(
             ['ssh-keygen', '-y', '-f', self.key[0]],
+            check=True,
             capture_output=True, encoding='utf-8'
         ).stdout.rstrip('\n')
 
@@ -201,56 +809,82 @@ class GuestDiana(tmt.GuestSsh):
         self.verbose('instance_name', self.instance_name, 'yellow')
         if self.opt('dry'):
             return
+        # Generate the ssh key while the installation is being prepared,
+        # cached images share the key which is handled under the cache lock
+        if not self.image_cache:
+            self._start_ssh_keygen()
         # Install the virtual machine
         try:
             self._install()
             # the VM is powered off after the installation
-        except (subprocess.CalledProcessError) as error:
+        except (subprocess.CalledProcessError, libvirt.libvirtError) as error:
             raise ProvisionError(
                 f'Failed to install OS on a libvirt guest ({error}).')
-        if self.guest_state != "running": # TODO: this should not be needed
-            self._virsh('start', self.instance_name)
+        try:
+            self._domain.create()
+        except libvirt.libvirtError as error:
+            # The domain is already running
+            if error.get_error_code() != libvirt.VIR_ERR_OPERATION_INVALID:
+                raise
+        self._invalidate_state()
         self.guest = self.get_guest_ip()
         self.port = 22
         self.verbose('ip', self.guest, 'green')
         self.verbose('port', str(self.port), 'green')
 
         # FIXME copied from Testcloud plugin
-        # Wait until it's possible to connect to guest via SSH
+        # Wait until it's possible to connect to guest via SSH, the lease
+        # is already there so ssh is usually up within a few seconds
         time_coeff = 1 # don't be smart!
         if not self.reconnect(
                 timeout=DEFAULT_CONNECT_TIMEOUT *
                 time_coeff,
-                tick=1):
+                tick=CONNECT_TICK,
+                tick_increase=CONNECT_TICK_INCREASE):
             raise ProvisionError(
                 f"Failed to connect in {DEFAULT_CONNECT_TIMEOUT * time_coeff}s.")
 
     def stop(self) -> None:
         """ Stop provisioned guest """
         super().stop()
-        self._virsh('shutdown', self.instance_name)
+        self._domain.shutdown()
+        self._invalidate_state()
         self.info('guest', 'stopped', 'green')
 
     def remove(self) -> None:
         """ Remove the guest (disk cleanup) """
+        # Cached state is good for polling only, not for destroying the guest
+        self._invalidate_state()
         if self.guest_state != "shut off":
-            self._virsh(
-                'destroy',
-                self.instance_name,
-            )
-            for i in range(10):
-                if self.guest_state == "shut off":
-                    break
-                time.sleep(1)
-        self._virsh(
-            'undefine',
-            '--remove-all-storage',
-            '--nvram',
-            '--tpm',
-            self.instance_name,
-        )
+            self._domain.destroy()
+            self._wait_for_state("shut off", 10)
+        self._undefine(self._domain)
+        self._invalidate_state()
         self.info('guest', 'removed', 'green')
 
+    def _undefine(self, domain: libvirt.virDomain) -> None:
+        """
+        Undefine the domain including its storage, NVRAM and TPM
+
+        Equivalent of virsh undefine --remove-all-storage --nvram --tpm
+        done over the already opened connection.
+        """
+        domain_xml = ET.fromstring(
+            domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        volumes = [
+            source.get('file')
+            for source in domain_xml.findall(
+                "./devices/disk[@device='disk']/source[@file]")
+            ]
+        domain.undefineFlags(
+            libvirt.VIR_DOMAIN_UNDEFINE_NVRAM
+            | getattr(libvirt, 'VIR_DOMAIN_UNDEFINE_TPM', 0))
+        for volume in volumes:
+            try:
+                self._conn.storageVolLookupByPath(volume).delete()
+            except libvirt.libvirtError as error:
+                self.warn(f"Failed to remove storage '{volume}' ({error}).")
+
     def reboot(self,
                hard: bool = False,
                command: Optional[Union[Command, ShellScript]] = None,
@@ -283,8 +917,16 @@ class ProvisionDiana(tmt.steps.provision.ProvisionPlugin):
         provision:
             how: diana
             location: http://...
-            hardware:
-                memory: 2 GB
+            image-cache: true
+            io-uring: true
+            kickstart-server: true
+            kickstart:
+                post-install: |
+                    %post
+                    ...
+                    %end
+
+    Hardware requirements are not supported yet.
     """
 
     _data_class = ProvisionDianaData